@@ -9,27 +9,34 @@ Authors: Michele Claus, Eurac Research - Inst. for Earth Observation, Bolzano/Bo
 Date: 2024-03-24
 """
 
+import concurrent.futures
 import datetime
-import json
+import functools
 import logging
 import os
+import shutil
+import tempfile
+import warnings
 from pathlib import Path
 from typing import Optional
 from urllib.parse import urlparse, urlunparse
 
 import boto3
+import boto3.s3.transfer
 import botocore
+import botocore.config
 import dask
 import numpy as np
 import pandas as pd
 import pystac
+import pystac.validation
 import rasterio
-
+import rasterio.shutil
 import ujson
 import xarray as xr
 from fsspec.implementations.local import LocalFileSystem
 from openeo.local import LocalConnection
-from pystac.utils import str_to_datetime
+from pystac.utils import datetime_to_str
 
 # Import rio_stac methods
 # Import extension version
@@ -55,6 +62,40 @@ _log = logging.getLogger(__name__)
 
 DATACUBE_EXT_VERSION = "v1.0.0"
 
+# Concurrent S3 uploads, the concurrent parts of each multipart upload and the
+# HTTP connections kept open for all of them
+_S3_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+_S3_MAX_TRANSFER_CONCURRENCY = 10
+_S3_MAX_POOL_CONNECTIONS = _S3_MAX_WORKERS * _S3_MAX_TRANSFER_CONCURRENCY
+_MiB = 1024 * 1024
+
+# Shared by all the netCDF to Kerchunk translations
+_LOCAL_FS = LocalFileSystem(skip_instant_cache=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_stac_validator():
+    # Shared by all the instances, so that schemas are fetched only once
+    return pystac.validation.JsonSchemaSTACValidator()
+
+
+@functools.lru_cache(maxsize=256)
+def _fix_path_slash(res_loc):
+    return res_loc if res_loc.endswith("/") else res_loc + "/"
+
+
+@functools.lru_cache(maxsize=1024)
+def _bbox_to_geom(minx, miny, maxx, maxy):
+    # The items of gridded data usually share the same footprint
+    return bbox_to_geom([minx, miny, maxx, maxy])
+
+
+@functools.lru_cache(maxsize=256)
+def _get_root_url(url):
+    parsed_url = urlparse(url)
+    # Extract protocol + domain
+    return urlunparse((parsed_url.scheme, parsed_url.netloc, "", "", "", ""))
+
 
 class Raster2STAC:
     """
@@ -102,6 +143,13 @@ class Raster2STAC:
             Scientific citation(s) reference(s) about STAC collection.
         write_collection_assets = False,
             Include all assets in the STAC Collection, with unique keys.
+        multiband_cog = False,
+            For the "COG" output format: write all the bands of a timestamp in a single multi-band COG,
+            described by a single "data" asset, instead of one COG and asset per band.
+        per_item_json = True,
+            Write every item also to its own JSON file in the "items" folder, besides inline_items.csv.
+        validate = True,
+            Validate the first generated item against the STAC JSON schemas (fetched online, once per process).
     """
 
     def __init__(
@@ -129,10 +177,11 @@ class Raster2STAC:
         sci_doi=None,
         sci_citation=None,
         write_collection_assets=False,
+        multiband_cog=False,
+        per_item_json=True,
+        validate=True,
     ):
         if ignore_warns:
-            import warnings
-
             warnings.filterwarnings("ignore")
 
         self.data = data
@@ -155,6 +204,9 @@ class Raster2STAC:
         self.stac_version = stac_version
         self.sci_doi = sci_doi
         self.write_collection_assets = write_collection_assets
+        self.multiband_cog = multiband_cog
+        self.per_item_json = per_item_json
+        self.validate = validate
         self.extensions = [
             f"https://stac-extensions.github.io/projection/{PROJECTION_EXT_VERSION}/schema.json",
             f"https://stac-extensions.github.io/raster/{RASTER_EXT_VERSION}/schema.json",
@@ -164,9 +216,9 @@ class Raster2STAC:
         if output_folder is not None:
             self.output_folder = output_folder
         else:
-            self.output_folder = datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S%f")[
-                :-3
-            ]
+            self.output_folder = datetime.datetime.now(datetime.timezone.utc).strftime(
+                "%Y%m%d%H%M%S%f"
+            )[:-3]
 
         self.output_file = f"{self.collection_id}.json"
 
@@ -178,16 +230,33 @@ class Raster2STAC:
         self.aws_region = aws_region
         self.s3_upload = s3_upload
         self.s3_client = None
+        self.s3_transfer_config = None
         self.version = version
         self.title = title
 
         if self.s3_upload:
             # Initializing an S3 client
+            # The client is shared by all the upload threads
             self.s3_client = boto3.client(
                 "s3",
                 aws_access_key_id=aws_access_key,
                 aws_secret_access_key=aws_secret_key,
+                config=botocore.config.Config(
+                    max_pool_connections=_S3_MAX_POOL_CONNECTIONS,
+                    tcp_keepalive=True,
+                    retries={"max_attempts": 10, "mode": "adaptive"},
+                ),
             )  # region_name=aws_region,
+            # Larger multipart chunks upload considerably faster than the
+            # default 8 MiB ones. Files are already uploaded in parallel, so
+            # keep the per-file concurrency at the default.
+            self.s3_transfer_config = boto3.s3.transfer.TransferConfig(
+                multipart_threshold=16 * _MiB,
+                multipart_chunksize=64 * _MiB,
+                max_concurrency=_S3_MAX_TRANSFER_CONCURRENCY,
+                use_threads=True,
+                io_chunksize=1 * _MiB,
+            )
         # available_output_formats = ["csv","json_full"]
         # if output_format not in available_output_formats:
         # raise ValueError(f"output_format can be set to one of {available_output_formats}")
@@ -198,7 +267,7 @@ class Raster2STAC:
         # TODO: implement following attributes: self.overwrite,
 
     def fix_path_slash(self, res_loc):
-        return res_loc if res_loc.endswith("/") else res_loc + "/"
+        return _fix_path_slash(res_loc)
 
     # TODO/FIXME: maybe better to put this method as an external static function? (and s3_client attribute as global variable)
     def upload_s3(self, file_path):
@@ -208,7 +277,12 @@ class Raster2STAC:
             object_name = f"{self.fix_path_slash(prefix)}{file_name}"
 
             try:
-                self.s3_client.upload_file(file_path, self.bucket_name, object_name)
+                self.s3_client.upload_file(
+                    file_path,
+                    self.bucket_name,
+                    object_name,
+                    Config=self.s3_transfer_config,
+                )
                 _log.debug(
                     f"Successfully uploaded {file_name} to {self.bucket_name} as {object_name}"
                 )
@@ -220,27 +294,200 @@ class Raster2STAC:
                 _log.debug(f'Error uploading file: {e.response["Error"]["Message"]}')
 
     def get_root_url(self, url):
-        parsed_url = urlparse(url)
-        # Extract protocol + domain
-        root_url = urlunparse((parsed_url.scheme, parsed_url.netloc, "", "", "", ""))
-        return root_url
+        return _get_root_url(url)
+
+    def _item_links_template(self, collection_href):
+        """
+        Build the links shared by all the items of the collection, to be reused
+        by _build_item_dict.
+
+        Args:
+            collection_href: str
+                URL of the collection of the items, also their parent.
+        """
+        return {
+            "collection": {
+                "rel": "collection",
+                "href": collection_href,
+                "type": "application/json",
+            },
+            "parent": {
+                "rel": "parent",
+                "href": collection_href,
+                "type": "application/json",
+            },
+            "root": {
+                "rel": "root",
+                "href": self.get_root_url(collection_href),
+                "type": "application/json",
+            },
+        }
+
+    def _collection_links(self, collection_href):
+        """
+        Build the links of the collection, keeping only the first link for each
+        (rel, href, type), followed by the user provided links.
+
+        Args:
+            collection_href: str
+                URL of the collection.
+        """
+        root_href = self.get_root_url(collection_href)
+        links = [
+            {
+                "rel": "items",
+                "href": f"{collection_href}/items",
+                "type": "application/json",
+            },
+            {"rel": "parent", "href": root_href, "type": "application/json"},
+            {"rel": "self", "href": collection_href, "type": "application/json"},
+            {"rel": "root", "href": root_href, "type": "application/json"},
+        ]
+        if self.links is not None:
+            links += self.links
+        unique_links = {}
+        for link in links:
+            unique_links.setdefault((link["rel"], link["href"], link.get("type")), link)
+        return list(unique_links.values())
+
+    def _cube_dimensions(self):
+        """
+        Build the datacube extension dimensions of the collection. The extents
+        are read from the (in memory) coordinates, without going through the
+        data of the cube.
+        """
+        x_values = self.data[self.X_DIM].values
+        y_values = self.data[self.Y_DIM].values
+        t_values = self.data[self.T_DIM].values
+        reference_system = int(self.data.rio.crs.to_string().split(":")[1])
+        return {
+            self.X_DIM: {
+                "axis": "x",
+                "type": "spatial",
+                "extent": [float(x_values.min()), float(x_values.max())],
+                "reference_system": reference_system,
+            },
+            self.Y_DIM: {
+                "axis": "y",
+                "type": "spatial",
+                "extent": [float(y_values.min()), float(y_values.max())],
+                "reference_system": reference_system,
+            },
+            self.T_DIM: {
+                "type": "temporal",
+                "extent": [str(t_values.min()), str(t_values.max())],
+            },
+            self.B_DIM: {
+                "type": "bands",
+                "values": list(self.data[self.B_DIM].values),
+            },
+        }
+
+    def _build_collection_dict(
+        self, bbox, temporal_extent, extra_fields, collection_href, assets=None
+    ):
+        """
+        Build the STAC collection dictionary, laid out as
+        pystac.Collection.to_dict() would, without building the pystac objects.
+
+        Args:
+            bbox: list
+                Overall bounding box of the items.
+            temporal_extent: list
+                Start and end datetimes of the items.
+            extra_fields: dict
+                Additional collection fields (stac_version, summaries,
+                cube:dimensions, ...).
+            collection_href: str
+                URL of the collection.
+            assets: dict
+                Collection asset dictionaries, if any.
+        """
+        collection_dict = {
+            "type": "Collection",
+            "id": self.collection_id,
+            "stac_version": pystac.get_stac_version(),
+            "description": self.description,
+            "links": self._collection_links(collection_href),
+            **extra_fields,
+            "extent": {
+                "spatial": {"bbox": [bbox]},
+                "temporal": {
+                    "interval": [[datetime_to_str(dt) for dt in temporal_extent]]
+                },
+            },
+            "license": self.license if self.license is not None else "other",
+        }
+        if assets:
+            collection_dict["assets"] = dict(assets)
+        return collection_dict
+
+    def _build_item_dict(self, item_id, bbox, properties, assets, self_href, links):
+        """
+        Build the dictionary of a STAC item, the same that
+        pystac.Item(...).to_dict() gives, without creating the pystac objects.
+
+        Args:
+            item_id: str
+                Identifier of the item.
+            bbox: list
+                Bounding box of the item, also used as its geometry.
+            properties: dict
+                Item properties, including the datetime fields already serialized.
+            assets: list
+                (key, asset dictionary) pairs of the item assets.
+            self_href: str
+                URL of the item itself.
+            links: dict
+                Links shared by all the items, from _item_links_template.
+        """
+        return {
+            "type": "Feature",
+            "stac_version": pystac.get_stac_version(),
+            "stac_extensions": self.extensions,
+            "id": item_id,
+            "geometry": _bbox_to_geom(*bbox),
+            "bbox": bbox,
+            "properties": properties,
+            "links": [
+                links["collection"],
+                links["parent"],
+                {"rel": "self", "href": self_href, "type": "application/json"},
+                links["root"],
+            ],
+            "assets": dict(assets),
+            "collection": self.collection_id,
+        }
 
     def generate_kerchunk_stac(self):
         from kerchunk.hdf import SingleHdf5ToZarr
 
         def gen_json(u, so, json_dir):
-            fs = LocalFileSystem(skip_instant_cache=True)
-            with fs.open(u, **so) as inf:
+            out_json = f"{str(json_dir)}/{u.split('/')[-1]}.json"
+            # Reuse the references of a previous run if the netCDF is unchanged
+            if os.path.exists(out_json) and os.path.getmtime(u) < os.path.getmtime(
+                out_json
+            ):
+                return out_json
+            with _LOCAL_FS.open(u, **so) as inf:
                 h5chunks = SingleHdf5ToZarr(inf, u, inline_threshold=300)
-                with open(f"{str(json_dir)}/{u.split('/')[-1]}.json", "wb") as outf:
-                    outf.write(ujson.dumps(h5chunks.translate()).encode())
-            return f"{str(json_dir)}/{u.split('/')[-1]}.json"
+                refs = h5chunks.translate()
+            # Move the JSON in place only once it is complete: a failed run must
+            # not leave behind a newer, partial file that the check above reuses
+            tmp_json = f"{out_json}.tmp"
+            try:
+                with open(tmp_json, "w") as outf:
+                    ujson.dump(refs, outf)
+                os.replace(tmp_json, out_json)
+            finally:
+                if os.path.exists(tmp_json):
+                    os.remove(tmp_json)
+            return out_json
 
         # Create the output folder for the Kerchunk files
         kerchunk_folder = os.path.join(self.output_folder, "kerchunk")
         Path(kerchunk_folder).mkdir(parents=True, exist_ok=True)
 
-        kerchunk_files_list = []
         # Read the list of netCDFs
         for same_time_netcdfs in self.data:
             t_labels = []
@@ -260,23 +507,24 @@ class Raster2STAC:
                     "The provided netCDFs contain a different set of dates!"
                 )
 
-            so = dict(mode="rb", anon=True, default_fill_cache=False)
-            same_time_kerchunks = dask.compute(
-                *[
-                    dask.delayed(gen_json)(var, so, kerchunk_folder)
-                    for var in same_time_netcdfs
-                ]
-            )
-            kerchunk_files_list.append(same_time_kerchunks)
+        # Translate the netCDFs one after the other: h5py serializes all its
+        # calls behind a single lock, so threads would not translate any faster
+        so = dict(mode="rb", anon=True, default_fill_cache=False)
+        kerchunk_files_list = [
+            [gen_json(var, so, kerchunk_folder) for var in same_time_netcdfs]
+            for same_time_netcdfs in self.data
+        ]
 
         # List of List json Kerchunk.
         # First list: each element (list) different year/time
         # Second list: each element different variables
-        datasets_list = []
+        # Every Kerchunk file is opened only once: the same (lazy) arrays are
+        # combined into the cube and then used to build the items
+        kerchunk_arrays = {}
         for same_time_data in kerchunk_files_list:
             for d in same_time_data:
                 if d.endswith(".json"):
-                    self.data = xr.open_dataset(
+                    kerchunk_arrays[d] = xr.open_dataset(
                         "reference://",
                         engine="zarr",
                         decode_coords="all",
@@ -289,9 +537,10 @@ class Raster2STAC:
                         chunks={},
                     ).to_dataarray(dim="bands")
                     # IS_KERCHUNK = True # UNUSED VARIABLE IS_KERCHUNK
-                    datasets_list.append(self.data)
                     # Need to create one Item per time/netCDF
-        self.data = xr.combine_by_coords(datasets_list, combine_attrs="drop_conflicts")
+        self.data = xr.combine_by_coords(
+            list(kerchunk_arrays.values()), combine_attrs="drop_conflicts"
+        )
         # raise ValueError("'data' paramter must be either xr.DataArray, a str (path to a netCDF) or a list of lists with paths to JSON Kerchunk files.")
 
         self.X_DIM = self.data.openeo.x_dim
@@ -313,8 +562,22 @@ class Raster2STAC:
 
         eo_info = {}
 
-        # resetting CSV file
-        open(f"{Path(self.output_folder)}/inline_items.csv", "w+")
+        # The one-line items, written at once to the CSV file at the end
+        csv_lines = []
+
+        jsons_path = f"{Path(self.output_folder)}/items/"
+        if self.per_item_json:
+            Path(jsons_path).mkdir(parents=True, exist_ok=True)
+
+        # The item links only differ by the item id
+        collection_href = (
+            f"{self.fix_path_slash(self.collection_url)}{self.collection_id}"
+        )
+        item_links = self._item_links_template(collection_href)
+
+        # Footprint and projection only depend on the grid of the data, usually
+        # shared by all the bands and time ranges: compute them once per grid
+        grids_info = {}
 
         _log.debug("Cycling all timestamps")
 
@@ -326,18 +589,7 @@ class Raster2STAC:
             bands_data = {}
             for d in same_time_data:
                 if d.endswith(".json"):
-                    band_data = xr.open_dataset(
-                        "reference://",
-                        engine="zarr",
-                        decode_coords="all",
-                        backend_kwargs={
-                            "storage_options": {
-                                "fo": d,
-                            },
-                            "consolidated": False,
-                        },
-                        chunks={},
-                    ).to_dataarray(dim="bands")
+                    band_data = kerchunk_arrays[d]
                     bands_data[d] = band_data
                     time_ranges.append(band_data[self.T_DIM].values)
             # for i,t_r in enumerate(time_ranges):
@@ -354,13 +606,18 @@ class Raster2STAC:
 
             # Now we can create one STAC Item for this time range, with one asset each band/variable
 
-            start_datetime = np.min(time_ranges[0])
-            end_datetime = np.max(time_ranges[0])
-
-            # Convert the time value to a datetime object
-            # Format the timestamp as a string to use in the file name
-            start_datetime_str = pd.Timestamp(start_datetime).strftime("%Y%m%d%H%M%S")
-            end_datetime_str = pd.Timestamp(end_datetime).strftime("%Y%m%d%H%M%S")
+            start_datetime = time_ranges[0].min()
+            end_datetime = time_ranges[0].max()
+
+            # Format the timestamps as strings (YYYYmmddHHMMSS) to use in the
+            # file names
+            start_datetime_str, end_datetime_str = (
+                np.datetime_as_string(dt, unit="s")
+                .replace("-", "")
+                .replace("T", "")
+                .replace(":", "")
+                for dt in (start_datetime, end_datetime)
+            )
 
             _log.debug(
                 f"Extracted temporal extrema for this time range: {start_datetime_str} {end_datetime_str}"
@@ -378,14 +635,15 @@ class Raster2STAC:
             # Get the band name (you may need to adjust this part based on your data)
             # bands = self.data[self.B_DIM].values
 
-            pystac_assets = []
+            item_assets = []
+            bboxes = []
 
             # Cycling all bands/variables
             _log.debug("Cycling all bands")
 
             eo_bands_list = []
-            for b_d in bands_data:
-                band = bands_data[b_d][self.B_DIM].values[0]
+            for b_d, band_data in bands_data.items():
+                band = band_data[self.B_DIM].values[0]
                 kerchunk_file = b_d
                 _log.debug(f"b: {band}")
 
@@ -398,29 +656,30 @@ class Raster2STAC:
 
                 #                     link_path = f"https://{self.bucket_name}.{self.aws_region}.amazonaws.com/{self.fix_path_slash(self.bucket_file_prefix)}{curr_file_name}"
 
-                bboxes = []
-
                 # Create an asset dictionary for this time slice
                 # Get BBOX and Footprint
-                _log.debug(bands_data[b_d].rio.crs)
-                _log.debug(bands_data[b_d].rio.bounds())
-
-                dataset_geom = rioxarray_get_dataset_geom(
-                    bands_data[b_d], densify_pts=0, precision=-1
-                )
+                crs = band_data.rio.crs
+                if _log.isEnabledFor(logging.DEBUG):
+                    _log.debug(crs)
+                    _log.debug(band_data.rio.bounds())
+
+                grid = (crs, band_data.rio.transform(), band_data.rio.shape)
+                if grid not in grids_info:
+                    dataset_geom = rioxarray_get_dataset_geom(
+                        band_data, densify_pts=0, precision=-1
+                    )
+                    proj_info = {
+                        f"proj:{name}": value
+                        for name, value in rioxarray_get_projection_info(
+                            band_data
+                        ).items()
+                    }
+                    grids_info[grid] = dataset_geom, proj_info
+                dataset_geom, proj_info = grids_info[grid]
                 bboxes.append(dataset_geom["bbox"])
 
-                proj_info = {
-                    f"proj:{name}": value
-                    for name, value in rioxarray_get_projection_info(
-                        bands_data[b_d]
-                    ).items()
-                }
-
                 raster_info = {
-                    "raster:bands": rioxarray_get_raster_info(
-                        bands_data[b_d], max_size=1024
-                    )
+                    "raster:bands": rioxarray_get_raster_info(band_data, max_size=1024)
                 }
 
                 band_dict = {"name": band}
@@ -429,120 +688,94 @@ class Raster2STAC:
 
                 eo_info["eo:bands"] = [band_dict]
 
-                pystac_assets.append(
+                item_assets.append(
                     (
                         band,
-                        pystac.Asset(
-                            href=link_path,
-                            media_type=self.media_type,
-                            extra_fields={**proj_info, **raster_info, **eo_info},
-                            roles=["data", "index"],
-                        ),
+                        {
+                            "href": link_path,
+                            "type": self.media_type,
+                            **proj_info,
+                            **raster_info,
+                            **eo_info,
+                            "roles": ["data", "index"],
+                        },
                     )
                 )
 
             eo_info["eo:bands"] = eo_bands_list
 
-            minx, miny, maxx, maxy = zip(*bboxes)
-            bbox = [min(minx), min(miny), max(maxx), max(maxy)]
+            bboxes = np.asarray(bboxes, dtype=np.float64)
+            bbox = (
+                bboxes[:, :2].min(axis=0).tolist() + bboxes[:, 2:].max(axis=0).tolist()
+            )
 
-            # item
-            item = pystac.Item(
-                id=item_id,
-                geometry=bbox_to_geom(bbox),
-                bbox=bbox,
-                collection=None,  # self.collection_id, #FIXME: da errore se lo si decommenta
-                stac_extensions=self.extensions,
-                datetime=None,
-                start_datetime=pd.Timestamp(start_datetime),
-                end_datetime=pd.Timestamp(end_datetime),
-                properties=self.properties,
+            item_properties = dict(self.properties)
+            # Convert the time values to datetime objects
+            item_properties["start_datetime"] = datetime_to_str(
+                pd.Timestamp(start_datetime)
+            )
+            item_properties["end_datetime"] = datetime_to_str(
+                pd.Timestamp(end_datetime)
             )
+            item_properties["datetime"] = None
 
             # Calculate the item's spatial extent and add it to the list
-            spatial_extents.append(item.bbox)
+            spatial_extents.append(bbox)
 
             # Calculate the item's temporal extent and add it to the list
             # item_datetime = item.start_datetime
-            temporal_extents.append(
-                [pd.Timestamp(start_datetime), pd.Timestamp(end_datetime)]
-            )
-
-            for key, asset in pystac_assets:
-                item.add_asset(key=key, asset=asset)
-
-            item.validate()
+            temporal_extents.append([start_datetime, end_datetime])
 
-            item.add_link(
-                pystac.Link(
-                    pystac.RelType.COLLECTION,
-                    f"{self.fix_path_slash(self.collection_url)}{self.collection_id}",
-                    media_type=pystac.MediaType.JSON,
-                )
-            )
-
-            item.add_link(
-                pystac.Link(
-                    pystac.RelType.PARENT,
-                    f"{self.fix_path_slash(self.collection_url)}{self.collection_id}",
-                    media_type=pystac.MediaType.JSON,
-                )
+            # item
+            item_dict = self._build_item_dict(
+                item_id,
+                bbox,
+                item_properties,
+                item_assets,
+                f"{collection_href}/{item_id}",
+                item_links,
             )
-
-            item.add_link(
-                pystac.Link(
-                    pystac.RelType.SELF,
-                    f"{self.fix_path_slash(self.collection_url)}{self.collection_id}/{item_id}",
-                    media_type=pystac.MediaType.JSON,
+            if self.validate and not csv_lines:
+                # All the items are built the same way: validating the first
+                # one is enough
+                pystac.validation.validate_dict(
+                    item_dict, validator=_get_stac_validator()
                 )
-            )
-
-            item_dict = item.to_dict()
-
-            # FIXME: persistent pystac bug or logical error (urllib error when adding root link to current item)
-            # now this link is added manually by editing the dict
-            item_dict["links"].append(
-                {
-                    "rel": "root",
-                    "href": self.get_root_url(
-                        f"{self.fix_path_slash(self.collection_url)}{self.collection_id}"
-                    ),
-                    "type": "application/json",
-                }
-            )
-
-            # self.stac_collection.add_item(item)
-            # Append the item to the list instead of adding it to the collection
-            # item_dict = item.to_dict()
-            item_dict["collection"] = self.collection_id
 
-            item_oneline = json.dumps(
-                item_dict, separators=(",", ":"), ensure_ascii=False
+            # ujson is already compact, don't let it escape the slashes of the hrefs
+            item_oneline = ujson.dumps(
+                item_dict, ensure_ascii=False, escape_forward_slashes=False
             )
-
-            output_path = Path(self.output_folder)
-            with open(f"{output_path}/inline_items.csv", "a+") as out_csv:
-                out_csv.write(f"{item_oneline}\n")
-
-            jsons_path = f"{output_path}/items/"
-            Path(jsons_path).mkdir(parents=True, exist_ok=True)
-
-            with open(
-                f"{self.fix_path_slash(jsons_path)}{item_id}.json", "w+"
-            ) as out_json:
-                out_json.write(json.dumps(item_dict, indent=4))
+            csv_lines.append(f"{item_oneline}\n")
+
+            if self.per_item_json:
+                # Reuse the compact serialization of the CSV line, so each item
+                # is only serialized once and written with a single call
+                with open(
+                    f"{jsons_path}{item_id}.json",
+                    "w+",
+                    encoding="utf-8",
+                ) as out_json:
+                    out_json.write(item_oneline)
+
+        with open(
+            f"{Path(self.output_folder)}/inline_items.csv", "w+", encoding="utf-8"
+        ) as out_csv:
+            out_csv.writelines(csv_lines)
 
         # Calculate overall spatial extent
-        minx, miny, maxx, maxy = zip(*spatial_extents)
-        overall_bbox = [min(minx), min(miny), max(maxx), max(maxy)]
+        spatial_extents = np.asarray(spatial_extents, dtype=np.float64)
+        overall_bbox = (
+            spatial_extents[:, :2].min(axis=0).tolist()
+            + spatial_extents[:, 2:].max(axis=0).tolist()
+        )
 
         # Calculate overall temporal extent
-        min_datetime = min(temporal_extents, key=lambda x: x[0])[0]
-        max_datetime = max(temporal_extents, key=lambda x: x[1])[1]
-        overall_temporal_extent = [min_datetime, max_datetime]
-
-        s_ext = pystac.SpatialExtent([overall_bbox])
-        t_ext = pystac.TemporalExtent([overall_temporal_extent])
+        temporal_extents = np.asarray(temporal_extents, dtype="datetime64[ns]")
+        overall_temporal_extent = [
+            pd.Timestamp(temporal_extents[:, 0].min()),
+            pd.Timestamp(temporal_extents[:, 1].max()),
+        ]
 
         extra_fields = {}
 
@@ -577,125 +810,25 @@ class Raster2STAC:
         )
         extra_fields["stac_extensions"] = self.extensions
 
-        cube_dimensons = {
-            self.X_DIM: {
-                "axis": "x",
-                "type": "spatial",
-                "extent": [
-                    float(self.data.coords[self.X_DIM].min()),
-                    float(self.data.coords[self.X_DIM].max()),
-                ],
-                "reference_system": int((self.data.rio.crs.to_string()).split(":")[1]),
-            },
-            self.Y_DIM: {
-                "axis": "y",
-                "type": "spatial",
-                "extent": [
-                    float(self.data.coords[self.Y_DIM].min()),
-                    float(self.data.coords[self.Y_DIM].max()),
-                ],
-                "reference_system": int((self.data.rio.crs.to_string()).split(":")[1]),
-            },
-            self.T_DIM: {
-                "type": "temporal",
-                "extent": [
-                    str(self.data[self.T_DIM].min().values),
-                    str(self.data[self.T_DIM].max().values),
-                ],
-            },
-            self.B_DIM: {
-                "type": "bands",
-                "values": list(self.data[self.B_DIM].values),
-            },
-        }
+        extra_fields["cube:dimensions"] = self._cube_dimensions()
 
-        extra_fields["cube:dimensions"] = cube_dimensons
-
-        self.stac_collection = pystac.collection.Collection(
-            id=self.collection_id,
-            description=self.description,
-            extent=pystac.Extent(spatial=s_ext, temporal=t_ext),
-            extra_fields=extra_fields,
+        stac_collection_dict = self._build_collection_dict(
+            overall_bbox, overall_temporal_extent, extra_fields, collection_href
         )
-
-        self.stac_collection.add_link(
-            pystac.Link(
-                pystac.RelType.ITEMS,
-                f"{self.fix_path_slash(self.collection_url)}{self.collection_id}/items",
-                media_type=pystac.MediaType.JSON,
-            )
+        json_str = ujson.dumps(
+            stac_collection_dict, indent=4, escape_forward_slashes=False
         )
 
-        self.stac_collection.add_link(
-            pystac.Link(
-                pystac.RelType.PARENT,
-                self.get_root_url(
-                    f"{self.fix_path_slash(self.collection_url)}{self.collection_id}/items"
-                ),
-                media_type=pystac.MediaType.JSON,
-            )
-        )
-
-        self.stac_collection.add_link(
-            pystac.Link(
-                pystac.RelType.SELF,
-                f"{self.fix_path_slash(self.collection_url)}{self.collection_id}",
-                media_type=pystac.MediaType.JSON,
-            )
-        )
-
-        # self.stac_collection.remove_links(rel=pystac.RelType.ROOT)
-
-        self.stac_collection.add_link(
-            pystac.Link(
-                pystac.RelType.ROOT,
-                self.get_root_url(
-                    f"{self.fix_path_slash(self.collection_url)}{self.collection_id}/items"
-                ),
-                media_type=pystac.MediaType.JSON,
-            )
-        )
-
-        if self.license is not None:
-            self.stac_collection.license = self.license
-
-        # Create a single JSON file with all the items
-        stac_collection_dict = self.stac_collection.to_dict()
-
-        # in order to solve the double "root" link bug/issue
-        links_dict = stac_collection_dict["links"]
-
-        ctr_roots = 0
-        self_exists = False
-        self_idx = 0
-
-        for idx, link in enumerate(links_dict):
-            if link["rel"] == "root":
-                ctr_roots = ctr_roots + 1
-            if link["rel"] == "self":
-                self_exists = True
-                self_idx = idx
-
-        if ctr_roots == 2 and self_exists:
-            for idx, link in enumerate(links_dict):
-                if (
-                    link["rel"] == "root"
-                    and link["href"] == links_dict[self_idx]["href"]
-                    and link["type"] == links_dict[self_idx]["type"]
-                ):
-                    del links_dict[idx]
-                    break
-
-        if self.links is not None:
-            stac_collection_dict["links"] = stac_collection_dict["links"] + self.links
-
-        json_str = json.dumps(stac_collection_dict, indent=4)
-
         # printing metadata.json test output file
         output_path = Path(self.output_folder) / Path(self.output_file)
         with open(output_path, "w+") as metadata:
             metadata.write(json_str)
 
+        # The collection is built as a plain dict, expose it as a pystac object
+        self.stac_collection = pystac.Collection.from_dict(
+            stac_collection_dict, migrate=False
+        )
+
         if self.s3_upload:
             # Uploading metadata JSON file to s3
             _log.debug(
@@ -705,8 +838,9 @@ class Raster2STAC:
 
     def generate_cog_stac(self):
         if isinstance(self.data, xr.Dataset):
-            # store datasets in  a placeholder
-            self.data_ds = self.data.copy(deep=True)
+            # store datasets in  a placeholder. The data is only read, so a
+            # shallow copy is enough: don't duplicate the whole cube in memory
+            self.data_ds = self.data.copy(deep=False)
             self.data = self.data.to_dataarray(dim="bands")
         elif isinstance(self.data, xr.DataArray):
             pass
@@ -729,402 +863,406 @@ class Raster2STAC:
             f"Extracted label dimensions from input are:\nx dimension:{self.X_DIM}\ny dimension:{self.Y_DIM}\nbands dimension:{self.B_DIM}\ntemporal dimension:{self.T_DIM}"
         )
 
-        if self.data_ds is None:
-            self.data_ds = self.data.to_dataset(dim=self.B_DIM)
-
-        spatial_extents = []
-        temporal_extents = []
-
-        collection_assets = {}
-        # Get the time dimension values
-        time_values = self.data[self.T_DIM].values
+        # Every COG is a (y, x) slice of a (time, band) pair
+        dims_order = (self.T_DIM, self.B_DIM, self.Y_DIM, self.X_DIM)
+        if sorted(self.data.dims) == sorted(dims_order):
+            self.data = self.data.transpose(*dims_order)
+
+        # A lazy (dask backed) cube would be re-evaluated for every single
+        # time/band slice. Stage it once to Zarr, one chunk per slice, so that
+        # every COG write becomes a plain chunk read. The COGs are written from
+        # this local cube, self.data is left as given.
+        cube = self.data
+        staging_zarr = None
+        try:
+            if dask.is_dask_collection(self.data):
+                staging_zarr = tempfile.mkdtemp(
+                    prefix="staging_", suffix=".zarr", dir=self.output_folder
+                )
+                _log.debug(f"Staging input data to {staging_zarr}")
+                # Keep the original fill value only, the remaining encoding (chunks,
+                # compression) is specific to the source format
+                fill_value = self.data.encoding.get("_FillValue")
+                self.data.chunk(
+                    {self.T_DIM: 1, self.B_DIM: 1, self.Y_DIM: -1, self.X_DIM: -1}
+                ).drop_encoding().to_dataset(name="data").to_zarr(
+                    staging_zarr,
+                    mode="w",
+                    consolidated=True,
+                    encoding={"data": {"_FillValue": fill_value}},
+                )
+                # Read the staged values back as they were written: masking the
+                # fill value would turn integer data into float
+                cube = xr.open_zarr(
+                    staging_zarr, decode_coords="all", mask_and_scale=False
+                )["data"]
+
+            if self.data_ds is None:
+                self.data_ds = self.data.to_dataset(dim=self.B_DIM)
+
+            def read_cog_metadata(path, read_geometry):
+                metadata = {}
+                # Only metadata is read: don't let GDAL list the directory looking
+                # for sidecar files we never write.
+                with (
+                    rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR"),
+                    rasterio.open(path, sharing=False) as src_dst,
+                ):
+                    if read_geometry:
+                        # Get BBOX and Footprint
+                        metadata["geom"] = get_dataset_geom(
+                            src_dst, densify_pts=0, precision=-1
+                        )
+                        metadata["proj"] = {
+                            f"proj:{name}": value
+                            for name, value in get_projection_info(src_dst).items()
+                        }
 
-        eo_info = {}
+                    # TODO: try to add this field to the COG. Currently not present in the files we write here.
+                    metadata["cloudcover"] = src_dst.get_tag_item(
+                        "CLOUDCOVER", "IMAGERY"
+                    )
+                    metadata["raster:bands"] = get_raster_info(src_dst, max_size=1024)
+                    metadata["eo:bands"] = get_eobands_info(src_dst)
+                return metadata
+
+            def write_cog(t_idx, b_idx, band, path, read_geometry):
+                # Writing a tiled GTiff first and translating it afterwards is
+                # considerably faster than writing with the COG driver directly.
+                # The intermediate GTiff is kept in memory, not on disk, and is
+                # left uncompressed: it is read only once, by the translation.
+                gtiff_options = dict(
+                    driver="GTiff",
+                    tiled=True,
+                    blockxsize=512,
+                    blockysize=512,
+                    BIGTIFF="IF_NEEDED",
+                )
+                with rasterio.MemoryFile(ext=".tif") as memfile:
+                    tmp_path = memfile.name
+                    # Write the result to the GeoTIFF file
+                    if b_idx is None:
+                        # All the bands of the time slice in a multi-band raster
+                        cube.isel({self.T_DIM: t_idx}).transpose(
+                            self.B_DIM, self.Y_DIM, self.X_DIM
+                        ).rio.to_raster(raster_path=tmp_path, **gtiff_options)
+                        with rasterio.open(tmp_path, "r+") as dst:
+                            for i, name in enumerate(bands, start=1):
+                                dst.set_band_description(i, f"{name}")
+                    elif isinstance(cube, xr.DataArray):
+                        cube.isel({self.T_DIM: t_idx, self.B_DIM: b_idx}).to_dataset(
+                            name=band
+                        ).rio.to_raster(raster_path=tmp_path, **gtiff_options)
+                    else:
+                        cog_file = self.data_ds.isel({self.T_DIM: t_idx})[band]
+                        cog_file.attrs["long_name"] = f"{band}"
+                        cog_file.to_dataset(name=band).rio.to_raster(
+                            raster_path=tmp_path, **gtiff_options
+                        )
+                    # The predictor makes the deflate compression considerably more
+                    # effective (smaller files to upload) at no cost for the readers
+                    with rasterio.Env(GDAL_NUM_THREADS="ALL_CPUS"):
+                        rasterio.shutil.copy(
+                            tmp_path,
+                            path,
+                            driver="COG",
+                            compress="deflate",
+                            predictor="YES",
+                            blocksize=512,
+                            num_threads="ALL_CPUS",
+                            bigtiff="IF_SAFER",
+                        )
+                if upload_executor is not None:
+                    # Queue the upload and go on writing the next COG
+                    _log.debug(
+                        f"Uploading {path} to {self.fix_path_slash(self.bucket_file_prefix)}{os.path.basename(path)}"
+                    )
+                    upload_futures.append(upload_executor.submit(self.upload_s3, path))
+                # Extract the metadata of the new COG in the same worker thread
+                return read_cog_metadata(path, read_geometry)
 
-        # resetting CSV file
-        open(f"{Path(self.output_folder)}/inline_items.csv", "w+")
+            spatial_extents = []
 
-        _log.debug("Cycling all timestamps")
+            collection_assets = {}
+            # Get the time dimension values
+            time_values = self.data[self.T_DIM].values
+            time_index = pd.DatetimeIndex(time_values)
+            # Format all the timestamps as strings to use in the file names
+            time_strs = time_index.strftime("%Y%m%d%H%M%S").tolist()
+            # and convert them to the datetimes of the items
+            item_datetimes = time_index.to_pydatetime()
 
-        # Cycling all timestamps
-        for t in time_values:
-            _log.debug(f"\nts: {t}")
+            # Get the band name (you may need to adjust this part based on your data)
+            bands = self.data[self.B_DIM].values
 
-            # Convert the time value to a datetime object
-            timestamp = pd.Timestamp(t)
+            # The (band index, asset key) of the COGs written for every timestamp
+            if self.multiband_cog:
+                cog_assets = [(None, "data")]
+            else:
+                cog_assets = list(enumerate(bands))
 
-            # Format the timestamp as a string to use in the file name
-            time_str = timestamp.strftime("%Y%m%d%H%M%S")
+            # Create a unique directory for each time slice
+            for time_str in time_strs:
+                os.makedirs(os.path.join(self.output_folder, time_str), exist_ok=True)
+
+            # Every written COG is queued for upload to S3 and uploaded by its own
+            # pool of threads, so a slow upload never holds back the writing
+            upload_executor = None
+            upload_futures = []
+            if self.s3_upload:
+                upload_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=_S3_MAX_WORKERS, thread_name_prefix="raster2stac-s3"
+                )
 
-            item_id = (
-                f"{f'{self.item_prefix}_' if self.item_prefix != '' else ''}{time_str}"
-            )
+            # Every (time, band) pair is an independent file: write all the COGs
+            # and read back their metadata in parallel. GDAL releases the GIL while
+            # encoding and computing statistics, so threads are enough.
+            # All the COGs are written from the same cube and share footprint, CRS,
+            # transform and shape: read them from the first one only.
+            _log.debug("Writing COGs")
+            try:
+                cog_metadata = dask.compute(
+                    *[
+                        dask.delayed(write_cog)(
+                            t_idx,
+                            b_idx,
+                            band,
+                            os.path.join(
+                                self.output_folder, time_str, f"{band}_{time_str}.tif"
+                            ),
+                            t_idx == 0 and asset_idx == 0,
+                        )
+                        for t_idx, time_str in enumerate(time_strs)
+                        for asset_idx, (b_idx, band) in enumerate(cog_assets)
+                    ],
+                    scheduler="threads",
+                )
+            finally:
+                if upload_executor is not None:
+                    # Wait for the uploads still in the queue
+                    upload_executor.shutdown(wait=True)
+            for future in upload_futures:
+                future.result()
 
-            # Create a unique directory for each time slice
-            time_slice_dir = os.path.join(self.output_folder, time_str)
+            eo_info = {}
 
-            if not os.path.exists(time_slice_dir):
-                os.makedirs(time_slice_dir)
+            # The one-line items, written at once to the CSV file at the end
+            csv_lines = []
 
-            # Get the band name (you may need to adjust this part based on your data)
-            bands = self.data[self.B_DIM].values
+            jsons_path = f"{Path(self.output_folder)}/items/"
+            if self.per_item_json:
+                Path(jsons_path).mkdir(parents=True, exist_ok=True)
 
-            pystac_assets = []
+            # The item links only differ by the item id
+            collection_href = (
+                f"{self.fix_path_slash(self.collection_url)}{self.collection_id}"
+            )
+            item_links = self._item_links_template(collection_href)
+            if self.s3_upload:
+                s3_href_prefix = f"https://{self.bucket_name}.{self.aws_region}.amazonaws.com/{self.fix_path_slash(self.bucket_file_prefix)}"
 
-            # Cycling all bands
-            _log.debug("Cycling all bands")
+            dataset_geom = cog_metadata[0]["geom"]
+            proj_info = cog_metadata[0]["proj"]
 
-            eo_bands_list = []
+            _log.debug("Cycling all timestamps")
 
-            for band in bands:
-                _log.debug(f"b: {band}")
+            # Cycling all timestamps
+            for t_idx, t in enumerate(time_values):
+                _log.debug(f"\nts: {t}")
 
-                curr_file_name = f"{band}_{time_str}.tif"
-                # Define the GeoTIFF file path for this time slice and band
-                path = os.path.join(time_slice_dir, curr_file_name)
-
-                # Write the result to the GeoTIFF file
-                if isinstance(self.data, xr.DataArray):
-                    self.data.loc[{self.T_DIM: t, self.B_DIM: band}].to_dataset(
-                        name=band
-                    ).rio.to_raster(raster_path=path, driver="COG")
-                else:
-                    cog_file = self.data_ds.loc[{self.T_DIM: t}][band]
-                    cog_file.attrs["long_name"] = f"{band}"
-                    cog_file.to_dataset(name=band).rio.to_raster(
-                        raster_path=path, driver="COG"
-                    )
+                time_str = time_strs[t_idx]
 
-                link_path = path
+                item_id = f"{f'{self.item_prefix}_' if self.item_prefix != '' else ''}{time_str}"
 
-                if self.s3_upload:
-                    # Uploading file to s3
-                    _log.debug(
-                        f"Uploading {path} to {self.fix_path_slash(self.bucket_file_prefix)}{os.path.basename(path)}"
-                    )
-                    self.upload_s3(path)
+                time_slice_dir = os.path.join(self.output_folder, time_str)
 
-                    link_path = f"https://{self.bucket_name}.{self.aws_region}.amazonaws.com/{self.fix_path_slash(self.bucket_file_prefix)}{curr_file_name}"
+                item_assets = []
+                # Fresh properties for every item, so that no value leaks from
+                # one item to the next one
+                item_properties = dict(self.properties)
 
-                bboxes = []
+                # Cycling all bands
+                _log.debug("Cycling all bands")
 
-                # Create an asset dictionary for this time slice
-                with rasterio.open(path) as src_dst:
-                    # Get BBOX and Footprint
-                    dataset_geom = get_dataset_geom(
-                        src_dst, densify_pts=0, precision=-1
-                    )
-                    bboxes.append(dataset_geom["bbox"])
+                eo_bands_list = []
 
-                    proj_info = {
-                        f"proj:{name}": value
-                        for name, value in get_projection_info(src_dst).items()
-                    }
+                for asset_idx, (b_idx, band) in enumerate(cog_assets):
+                    _log.debug(f"b: {band}")
 
-                    raster_info = {
-                        "raster:bands": get_raster_info(src_dst, max_size=1024)
-                    }
+                    curr_file_name = f"{band}_{time_str}.tif"
+                    # Define the GeoTIFF file path for this time slice and band
+                    path = os.path.join(time_slice_dir, curr_file_name)
 
-                    band_dict = get_eobands_info(src_dst)[0]
+                    link_path = path
 
-                    # if type(band_dict) == dict:
-                    if isinstance(band_dict, dict):
-                        del band_dict["name"]
-                        band_dict["name"] = band_dict["description"]
-                        del band_dict["description"]
-                    else:
-                        pass  # band_dict = {}
+                    if self.s3_upload:
+                        # The file has been uploaded to s3 right after its writing
+                        link_path = f"{s3_href_prefix}{curr_file_name}"
 
-                    eo_bands_list.append(
-                        band_dict
-                    )  # TODO: add to dict, rename description with name and remove name
+                    # Create an asset dictionary for this time slice
+                    metadata = cog_metadata[t_idx * len(cog_assets) + asset_idx]
 
-                    cloudcover = src_dst.get_tag_item("CLOUDCOVER", "IMAGERY")
-                    # TODO: try to add this field to the COG. Currently not present in the files we write here.
-                    if cloudcover is not None:
-                        self.properties.update({"eo:cloud_cover": int(cloudcover)})
+                    if asset_idx == 0:
+                        # CLOUDCOVER is a scene level value
+                        cloudcover = metadata["cloudcover"]
+                        if cloudcover is not None:
+                            item_properties["eo:cloud_cover"] = int(cloudcover)
 
-                    eo_info["eo:bands"] = [band_dict]
+                    raster_info = {"raster:bands": metadata["raster:bands"]}
 
-                    asset = pystac.Asset(
-                        href=link_path,
-                        media_type=self.media_type,
-                        extra_fields={**proj_info, **raster_info, **eo_info},
-                        roles=["data"],
-                    )
-                    pystac_assets.append(
-                        (
-                            band,
-                            asset,
-                        )
-                    )
+                    # Use the band description as its name
+                    band_dicts = [
+                        {
+                            **{
+                                k: v
+                                for k, v in band_dict.items()
+                                if k not in ("name", "description")
+                            },
+                            "name": band_dict["description"],
+                        }
+                        if isinstance(band_dict, dict)
+                        else band_dict
+                        for band_dict in metadata["eo:bands"]
+                    ]
+
+                    eo_bands_list.extend(band_dicts)
+
+                    eo_info["eo:bands"] = band_dicts
+
+                    # Laid out as pystac.Asset.to_dict() would
+                    asset = {
+                        "href": link_path,
+                        "type": self.media_type,
+                        **proj_info,
+                        **raster_info,
+                        **eo_info,
+                        "roles": ["data"],
+                    }
+                    item_assets.append((band, asset))
                     if self.write_collection_assets:
                         collection_assets[f"{item_id}_{band}"] = asset
 
-            eo_info["eo:bands"] = eo_bands_list
+                eo_info["eo:bands"] = eo_bands_list
 
-            minx, miny, maxx, maxy = zip(*bboxes)
-            bbox = [min(minx), min(miny), max(maxx), max(maxy)]
+                bbox = dataset_geom["bbox"]
 
-            # item
-            item = pystac.Item(
-                id=item_id,
-                geometry=bbox_to_geom(bbox),
-                bbox=bbox,
-                collection=None,
-                stac_extensions=self.extensions,
-                datetime=str_to_datetime(str(t)),
-                properties=self.properties,
-            )
+                item_datetime = item_datetimes[t_idx]
+                item_properties["datetime"] = datetime_to_str(item_datetime)
 
-            # Calculate the item's spatial extent and add it to the list
-            item_bbox = item.bbox
-            spatial_extents.append(item_bbox)
-
-            # Calculate the item's temporal extent and add it to the list
-            item_datetime = item.datetime
-            temporal_extents.append([item_datetime, item_datetime])
-
-            for key, asset in pystac_assets:
-                item.add_asset(key=key, asset=asset)
-            item.validate()
-
-            item.add_link(
-                pystac.Link(
-                    pystac.RelType.COLLECTION,
-                    f"{self.fix_path_slash(self.collection_url)}{self.collection_id}",
-                    media_type=pystac.MediaType.JSON,
-                )
-            )
+                # Calculate the item's spatial extent and add it to the list
+                spatial_extents.append(bbox)
 
-            item.add_link(
-                pystac.Link(
-                    pystac.RelType.PARENT,
-                    f"{self.fix_path_slash(self.collection_url)}{self.collection_id}",
-                    media_type=pystac.MediaType.JSON,
+                # item
+                item_dict = self._build_item_dict(
+                    item_id,
+                    bbox,
+                    item_properties,
+                    item_assets,
+                    f"{collection_href}/items/{item_id}",
+                    item_links,
                 )
-            )
+                if self.validate and not csv_lines:
+                    # All the items are built the same way: validating the first
+                    # one is enough
+                    pystac.validation.validate_dict(
+                        item_dict, validator=_get_stac_validator()
+                    )
 
-            item.add_link(
-                pystac.Link(
-                    pystac.RelType.SELF,
-                    f"{self.fix_path_slash(self.collection_url)}{self.collection_id}/items/{item_id}",
-                    media_type=pystac.MediaType.JSON,
+                # if self.output_format == "json_full":
+                # elif self.output_format == "csv":
+                # ujson is already compact, don't let it escape the slashes of the hrefs
+                item_oneline = ujson.dumps(
+                    item_dict, ensure_ascii=False, escape_forward_slashes=False
                 )
-            )
-
-            item_dict = item.to_dict()
-
-            # FIXME: persistent pystac bug or logical error (urllib error when adding root link to current item)
-            # now this link is added manually by editing the dict
-            item_dict["links"].append(
-                {
-                    "rel": "root",
-                    "href": self.get_root_url(
-                        f"{self.fix_path_slash(self.collection_url)}{self.collection_id}"
-                    ),
-                    "type": "application/json",
-                }
-            )
-
-            # self.stac_collection.add_item(item)
-            # Append the item to the list instead of adding it to the collection
-            # item_dict = item.to_dict()
-            item_dict["collection"] = self.collection_id
-
-            # if self.output_format == "json_full":
-            # elif self.output_format == "csv":
-            item_oneline = json.dumps(
-                item_dict, separators=(",", ":"), ensure_ascii=False
-            )
-
-            output_path = Path(self.output_folder)
-            with open(f"{output_path}/inline_items.csv", "a+") as out_csv:
-                out_csv.write(f"{item_oneline}\n")
-
-            jsons_path = f"{output_path}/items/"
-            Path(jsons_path).mkdir(parents=True, exist_ok=True)
+                csv_lines.append(f"{item_oneline}\n")
+
+                if self.per_item_json:
+                    # Reuse the compact serialization of the CSV line, so each item
+                    # is only serialized once and written with a single call
+                    with open(
+                        f"{jsons_path}{item_id}.json",
+                        "w+",
+                        encoding="utf-8",
+                    ) as out_json:
+                        out_json.write(item_oneline)
 
             with open(
-                f"{self.fix_path_slash(jsons_path)}{item_id}.json", "w+"
-            ) as out_json:
-                out_json.write(json.dumps(item_dict, indent=4))
-
-        # Calculate overall spatial extent
-        minx, miny, maxx, maxy = zip(*spatial_extents)
-        overall_bbox = [min(minx), min(miny), max(maxx), max(maxy)]
+                f"{Path(self.output_folder)}/inline_items.csv", "w+", encoding="utf-8"
+            ) as out_csv:
+                out_csv.writelines(csv_lines)
+
+            # Calculate overall spatial extent
+            spatial_extents = np.asarray(spatial_extents, dtype=np.float64)
+            overall_bbox = (
+                spatial_extents[:, :2].min(axis=0).tolist()
+                + spatial_extents[:, 2:].max(axis=0).tolist()
+            )
 
-        # Calculate overall temporal extent
-        min_datetime = min(temporal_extents, key=lambda x: x[0])[0]
-        max_datetime = max(temporal_extents, key=lambda x: x[1])[1]
-        overall_temporal_extent = [min_datetime, max_datetime]
+            # Calculate overall temporal extent: every item has one of the
+            # timestamps of the cube as its datetime
+            overall_temporal_extent = [time_index.min(), time_index.max()]
 
-        s_ext = pystac.SpatialExtent([overall_bbox])
-        t_ext = pystac.TemporalExtent([overall_temporal_extent])
+            extra_fields = {}
 
-        extra_fields = {}
+            extra_fields["stac_version"] = self.stac_version
 
-        extra_fields["stac_version"] = self.stac_version
+            if self.keywords is not None:
+                extra_fields["keywords"] = self.keywords
 
-        if self.keywords is not None:
-            extra_fields["keywords"] = self.keywords
+            if self.providers is not None:
+                extra_fields["providers"] = self.providers
 
-        if self.providers is not None:
-            extra_fields["providers"] = self.providers
+            if self.version is not None:
+                extra_fields["version"] = self.version
 
-        if self.version is not None:
-            extra_fields["version"] = self.version
+            if self.title is not None:
+                extra_fields["title"] = self.title
 
-        if self.title is not None:
-            extra_fields["title"] = self.title
+            if self.sci_citation is not None:
+                extra_fields["sci:citation"] = self.sci_citation
 
-        if self.sci_citation is not None:
-            extra_fields["sci:citation"] = self.sci_citation
+            if self.sci_doi is not None:
+                extra_fields["sci:doi"] = self.sci_doi
 
-        if self.sci_doi is not None:
-            extra_fields["sci:doi"] = self.sci_doi
+            if self.sci_citation is not None or self.sci_doi is not None:
+                self.extensions.append(
+                    "https://stac-extensions.github.io/scientific/v1.0.0/schema.json"
+                )
 
-        if self.sci_citation is not None or self.sci_doi is not None:
+            extra_fields["summaries"] = eo_info
             self.extensions.append(
-                "https://stac-extensions.github.io/scientific/v1.0.0/schema.json"
+                "https://stac-extensions.github.io/datacube/v2.2.0/schema.json"
             )
-
-        extra_fields["summaries"] = eo_info
-        self.extensions.append(
-            "https://stac-extensions.github.io/datacube/v2.2.0/schema.json"
-        )
-        extra_fields["stac_extensions"] = self.extensions
-
-        cube_dimensons = {
-            self.X_DIM: {
-                "axis": "x",
-                "type": "spatial",
-                "extent": [
-                    float(self.data.coords[self.X_DIM].min()),
-                    float(self.data.coords[self.X_DIM].max()),
-                ],
-                "reference_system": int(self.data.rio.crs.to_string().split(":")[1]),
-            },
-            self.Y_DIM: {
-                "axis": "y",
-                "type": "spatial",
-                "extent": [
-                    float(self.data.coords[self.Y_DIM].min()),
-                    float(self.data.coords[self.Y_DIM].max()),
-                ],
-                "reference_system": int(self.data.rio.crs.to_string().split(":")[1]),
-            },
-            self.T_DIM: {
-                "type": "temporal",
-                "extent": [
-                    str(self.data[self.T_DIM].min().values),
-                    str(self.data[self.T_DIM].max().values),
-                ],
-            },
-            self.B_DIM: {
-                "type": "bands",
-                "values": list(self.data[self.B_DIM].values),
-            },
-        }
-
-        extra_fields["cube:dimensions"] = cube_dimensons
-        if self.write_collection_assets:
-            self.stac_collection = pystac.collection.Collection(
-                id=self.collection_id,
-                description=self.description,
-                extent=pystac.Extent(spatial=s_ext, temporal=t_ext),
-                extra_fields=extra_fields,
-                assets=collection_assets,
+            extra_fields["stac_extensions"] = self.extensions
+
+            extra_fields["cube:dimensions"] = self._cube_dimensions()
+            stac_collection_dict = self._build_collection_dict(
+                overall_bbox,
+                overall_temporal_extent,
+                extra_fields,
+                collection_href,
+                collection_assets if self.write_collection_assets else None,
             )
-        else:
-            self.stac_collection = pystac.collection.Collection(
-                id=self.collection_id,
-                description=self.description,
-                extent=pystac.Extent(spatial=s_ext, temporal=t_ext),
-                extra_fields=extra_fields,
+            json_str = ujson.dumps(
+                stac_collection_dict, indent=4, escape_forward_slashes=False
             )
 
-        self.stac_collection.add_link(
-            pystac.Link(
-                pystac.RelType.ITEMS,
-                f"{self.fix_path_slash(self.collection_url)}{self.collection_id}/items",
-                media_type=pystac.MediaType.JSON,
-            )
-        )
-
-        self.stac_collection.add_link(
-            pystac.Link(
-                pystac.RelType.PARENT,
-                self.get_root_url(
-                    f"{self.fix_path_slash(self.collection_url)}{self.collection_id}/items"
-                ),
-                media_type=pystac.MediaType.JSON,
-            )
-        )
+            # printing metadata.json test output file
+            output_path = Path(self.output_folder) / Path(self.output_file)
+            with open(output_path, "w+") as metadata:
+                metadata.write(json_str)
 
-        self.stac_collection.add_link(
-            pystac.Link(
-                pystac.RelType.SELF,
-                f"{self.fix_path_slash(self.collection_url)}{self.collection_id}",
-                media_type=pystac.MediaType.JSON,
+            # The collection is built as a plain dict, expose it as a pystac object
+            self.stac_collection = pystac.Collection.from_dict(
+                stac_collection_dict, migrate=False
             )
-        )
-
-        # self.stac_collection.remove_links(rel=pystac.RelType.ROOT)
-
-        self.stac_collection.add_link(
-            pystac.Link(
-                pystac.RelType.ROOT,
-                self.get_root_url(
-                    f"{self.fix_path_slash(self.collection_url)}{self.collection_id}/items"
-                ),
-                media_type=pystac.MediaType.JSON,
-            )
-        )
-
-        if self.license is not None:
-            self.stac_collection.license = self.license
-
-        # Create a single JSON file with all the items
-        stac_collection_dict = self.stac_collection.to_dict()
-
-        # in order to solve the double "root" link bug/issue
-        links_dict = stac_collection_dict["links"]
-
-        ctr_roots = 0
-        self_exists = False
-        self_idx = 0
-
-        for idx, link in enumerate(links_dict):
-            if link["rel"] == "root":
-                ctr_roots = ctr_roots + 1
-            if link["rel"] == "self":
-                self_exists = True
-                self_idx = idx
 
-        if ctr_roots == 2 and self_exists:
-            for idx, link in enumerate(links_dict):
-                if (
-                    link["rel"] == "root"
-                    and link["href"] == links_dict[self_idx]["href"]
-                    and link["type"] == links_dict[self_idx]["type"]
-                ):
-                    del links_dict[idx]
-                    break
-
-        if self.links is not None:
-            stac_collection_dict["links"] = stac_collection_dict["links"] + self.links
-
-        json_str = json.dumps(stac_collection_dict, indent=4)
-
-        # printing metadata.json test output file
-        output_path = Path(self.output_folder) / Path(self.output_file)
-        with open(output_path, "w+") as metadata:
-            metadata.write(json_str)
-
-        if self.s3_upload:
-            # Uploading metadata JSON file to s3
-            _log.debug(
-                f'Uploading metatada JSON "{output_path}" to {self.fix_path_slash(self.bucket_file_prefix)}{os.path.basename(output_path)}'
-            )
-            self.upload_s3(output_path)
+            if self.s3_upload:
+                # Uploading metadata JSON file to s3
+                _log.debug(
+                    f'Uploading metatada JSON "{output_path}" to {self.fix_path_slash(self.bucket_file_prefix)}{os.path.basename(output_path)}'
+                )
+                self.upload_s3(output_path)
+        finally:
+            if staging_zarr is not None:
+                shutil.rmtree(staging_zarr, ignore_errors=True)
@@ -259,6 +259,20 @@ def rioxarray_get_raster_info(  # noqa: C901
     # if src_dst.rio.units[0] is not None:
     #     value["unit"] = src_dst.rio.units[0]
 
+    # As rio-stac reads a decimated overview, compute the statistics on at most
+    # max_size pixels along each side, instead of reading the whole raster
+    if (height, width) != (src_dst.rio.height, src_dst.rio.width):
+        src_dst = src_dst.isel(
+            {
+                src_dst.rio.y_dim: slice(
+                    None, None, math.ceil(src_dst.rio.height / height)
+                ),
+                src_dst.rio.x_dim: slice(
+                    None, None, math.ceil(src_dst.rio.width / width)
+                ),
+            }
+        )
+
     value.update(_rioxarray_get_stats(src_dst))
     meta.append(value)
 
@@ -386,7 +400,9 @@ def create_stac_item(
             dst_datetime = str_to_datetime(dst_date) if dst_date else None
 
             input_datetime = (
-                input_datetime or dst_datetime or datetime.datetime.utcnow()
+                input_datetime
+                or dst_datetime
+                or datetime.datetime.now(datetime.timezone.utc)
             )
 
         # add projection properties
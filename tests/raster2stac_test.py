@@ -1,9 +1,13 @@
+import datetime
+import glob
 import os
 import json
 from pathlib import Path
 import tempfile
 import numpy as np
 import pandas as pd
+import pystac
+import rasterio
 import xarray as xr
 
 import pytest
@@ -13,6 +17,8 @@ from rio_cogeo.cogeo import cog_translate
 from rio_cogeo.profiles import cog_profiles
 
 from raster2stac import Raster2STAC
+from raster2stac.raster2stac import _S3_MAX_WORKERS, _get_stac_validator
+from raster2stac.rioxarray_stac import rioxarray_get_raster_info
 from stac_validator import stac_validator
 
 
@@ -279,6 +285,286 @@ def test_generate_stac(request, test_data):
             assert stac.message[0]["valid_stac"]
 
 
+def test_generate_cog_stac_keeps_properties(r2s_sample_data_array):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        r2s = Raster2STAC(
+            data=r2s_sample_data_array,
+            collection_id="R2S_TEST_COLLECTION",
+            collection_url="https://10.8.244.74:8082/collections/",
+            output_folder=os.path.join(tmpdir, "R2S_TEST_COLLECTION"),
+            ignore_warns=True,
+        )
+        r2s.generate_cog_stac()
+
+        # item properties (e.g. the datetime) must not leak into the shared dict
+        assert r2s.properties == {}
+
+
+def test_generate_cog_stac_without_item_jsons(r2s_sample_dataset):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output_folder = os.path.join(tmpdir, "R2S_TEST_COLLECTION")
+        r2s = Raster2STAC(
+            data=r2s_sample_dataset,
+            collection_id="R2S_TEST_COLLECTION",
+            collection_url="https://10.8.244.74:8082/collections/",
+            output_folder=output_folder,
+            ignore_warns=True,
+            per_item_json=False,
+        )
+        r2s.generate_cog_stac()
+
+        assert not os.path.exists(os.path.join(output_folder, "items"))
+        with open(os.path.join(output_folder, "inline_items.csv")) as f:
+            items = [json.loads(line) for line in f]
+        assert len(items) == r2s_sample_dataset.sizes["time"]
+
+
+@patch("pystac.validation.validate_dict")
+def test_generate_cog_stac_without_validation(mock_validate, r2s_sample_dataset):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        r2s = Raster2STAC(
+            data=r2s_sample_dataset,
+            collection_id="R2S_TEST_COLLECTION",
+            collection_url="https://10.8.244.74:8082/collections/",
+            output_folder=os.path.join(tmpdir, "R2S_TEST_COLLECTION"),
+            ignore_warns=True,
+            validate=False,
+        )
+        r2s.generate_cog_stac()
+
+    mock_validate.assert_not_called()
+
+
+def test_generate_cog_stac_multiband(r2s_sample_dataset):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output_folder = os.path.join(tmpdir, "R2S_TEST_COLLECTION")
+        r2s = Raster2STAC(
+            data=r2s_sample_dataset,
+            collection_id="R2S_TEST_COLLECTION",
+            collection_url="https://10.8.244.74:8082/collections/",
+            output_folder=output_folder,
+            ignore_warns=True,
+            multiband_cog=True,
+        )
+        r2s.generate_cog_stac()
+
+        bands = list(r2s_sample_dataset.data_vars)
+        item_paths = glob.glob(os.path.join(output_folder, "items", "*.json"))
+        assert item_paths
+        for item_path in item_paths:
+            with open(item_path) as f:
+                item = json.load(f)
+            assert list(item["assets"]) == ["data"]
+            asset = item["assets"]["data"]
+            assert [b["name"] for b in asset["eo:bands"]] == bands
+            assert len(asset["raster:bands"]) == len(bands)
+            with rasterio.open(asset["href"]) as src:
+                assert src.count == len(bands)
+                assert list(src.descriptions) == bands
+
+
+def test_generate_cog_stac_dask_input(r2s_sample_dataset):
+    data = r2s_sample_dataset.chunk()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output_folder = os.path.join(tmpdir, "R2S_TEST_COLLECTION")
+        r2s = Raster2STAC(
+            data=data,
+            collection_id="R2S_TEST_COLLECTION",
+            collection_url="https://10.8.244.74:8082/collections/",
+            output_folder=output_folder,
+            ignore_warns=True,
+        )
+        r2s.generate_cog_stac()
+
+        # the staging store is removed and the input data is still readable
+        assert not glob.glob(os.path.join(output_folder, "*.zarr"))
+        expected = data.to_dataarray(dim="bands").transpose(*r2s.data.dims)
+        np.testing.assert_array_equal(r2s.data.values, expected.values)
+
+
+def test_generate_cog_stac_dask_integer_input():
+    np.random.seed(42)
+    values = np.random.randint(0, 500, size=(2, 2, 25, 25)).astype("int16")
+    values[..., :5, :5] = -9999
+    data = (
+        xr.DataArray(
+            values,
+            dims=["time", "bands", "y", "x"],
+            coords={
+                "time": pd.date_range("2024-06-06", periods=2),
+                "bands": ["band1", "band2"],
+                "y": np.linspace(45, 32, 25),
+                "x": np.linspace(52, 60, 25),
+            },
+        )
+        .rio.write_crs("EPSG:4326")
+        .rio.write_nodata(-9999)
+    )
+
+    outputs = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, input_data in (("memory", data), ("dask", data.chunk())):
+            output_folder = os.path.join(tmpdir, name)
+            Raster2STAC(
+                data=input_data,
+                collection_id="R2S_TEST_COLLECTION",
+                collection_url="https://10.8.244.74:8082/collections/",
+                output_folder=output_folder,
+                ignore_warns=True,
+                validate=False,
+            ).generate_cog_stac()
+
+            with open(os.path.join(output_folder, "inline_items.csv")) as f:
+                items = [json.loads(line) for line in f]
+            cogs = {}
+            for item in items:
+                for key, asset in item["assets"].items():
+                    with rasterio.open(asset["href"]) as src:
+                        cogs[(item["id"], key)] = (
+                            src.dtypes,
+                            src.nodata,
+                            src.read(),
+                            asset["raster:bands"],
+                        )
+            outputs[name] = cogs
+
+    # the staged dask input is written with the dtype and nodata of the source
+    assert outputs["dask"].keys() == outputs["memory"].keys()
+    for key, (dtypes, nodata, pixels, raster_bands) in outputs["dask"].items():
+        expected_dtypes, expected_nodata, expected_pixels, expected_bands = outputs[
+            "memory"
+        ][key]
+        assert dtypes == expected_dtypes == ("int16",)
+        assert nodata == expected_nodata == -9999
+        np.testing.assert_array_equal(pixels, expected_pixels)
+        assert raster_bands == expected_bands
+        assert [b["data_type"] for b in raster_bands] == ["int16"]
+
+
+def test_generate_cog_stac_collection_matches_pystac(r2s_sample_dataset):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output_folder = os.path.join(tmpdir, "R2S_TEST_COLLECTION")
+        r2s = Raster2STAC(
+            data=r2s_sample_dataset,
+            collection_id="R2S_TEST_COLLECTION",
+            collection_url="https://10.8.244.74:8082/collections/",
+            output_folder=output_folder,
+            ignore_warns=True,
+            write_collection_assets=True,
+        )
+        r2s.generate_cog_stac()
+
+        with open(os.path.join(output_folder, r2s.output_file)) as f:
+            collection_dict = json.load(f)
+
+    # the hand-built collection must serialize as pystac would
+    collection = pystac.Collection.from_dict(
+        collection_dict, preserve_dict=True, migrate=False
+    )
+    expected = collection.to_dict(transform_hrefs=False)
+    expected["stac_version"] = collection_dict["stac_version"]
+    assert collection_dict == expected
+    assert len(collection_dict["assets"]) == len(r2s_sample_dataset.data_vars)
+
+    assert isinstance(r2s.stac_collection, pystac.Collection)
+    assert r2s.stac_collection.id == collection_dict["id"]
+    assert r2s.stac_collection.extent.to_dict() == collection_dict["extent"]
+
+
+def test_generate_kerchunk_stac_reuses_references(r2s_sample_dataset, tmp_path):
+    from kerchunk.hdf import SingleHdf5ToZarr
+
+    nc_files = []
+    for i, day in enumerate(["2024-06-06", "2024-06-07"]):
+        nc_file = tmp_path / f"r2s_nc_file_{i}.nc"
+        r2s_sample_dataset.assign_coords(time=[np.datetime64(day)]).to_netcdf(nc_file)
+        nc_files.append([str(nc_file)])
+    output_folder = tmp_path / "R2S_TEST_COLLECTION"
+    references = [
+        output_folder / "kerchunk" / f"r2s_nc_file_{i}.nc.json" for i in range(2)
+    ]
+
+    def generate():
+        with patch(
+            "kerchunk.hdf.SingleHdf5ToZarr", wraps=SingleHdf5ToZarr
+        ) as translator:
+            Raster2STAC(
+                data=nc_files,
+                collection_id="R2S_TEST_COLLECTION",
+                collection_url="https://10.8.244.74:8082/collections/",
+                output_folder=str(output_folder),
+                ignore_warns=True,
+                validate=False,
+            ).generate_kerchunk_stac()
+        return [call.args[1] for call in translator.call_args_list]
+
+    assert generate() == [files[0] for files in nc_files]
+    assert all(reference.exists() for reference in references)
+
+    # an unchanged netCDF reuses the references of the previous run
+    assert generate() == []
+
+    # a newer netCDF is translated again
+    mtime = os.path.getmtime(references[0]) + 10
+    os.utime(nc_files[0][0], (mtime, mtime))
+    assert generate() == [nc_files[0][0]]
+
+    # a failed translation leaves no reference behind, complete or partial
+    for reference in references:
+        reference.unlink()
+    with (
+        patch("kerchunk.hdf.SingleHdf5ToZarr") as translator,
+        pytest.raises(TypeError),
+    ):
+        translator.return_value.translate.return_value = {"refs": object()}
+        Raster2STAC(
+            data=nc_files,
+            collection_id="R2S_TEST_COLLECTION",
+            collection_url="https://10.8.244.74:8082/collections/",
+            output_folder=str(output_folder),
+            ignore_warns=True,
+            validate=False,
+        ).generate_kerchunk_stac()
+    assert not list((output_folder / "kerchunk").glob("*.json*"))
+
+
+def test_raster_info_statistics_on_decimated_raster():
+    data = xr.DataArray(
+        np.arange(40 * 10, dtype="float64").reshape(40, 10),
+        dims=["y", "x"],
+        coords={"y": np.arange(40.0), "x": np.arange(10.0)},
+    ).rio.write_crs("EPSG:4326")
+
+    stats = rioxarray_get_raster_info(data, max_size=20)[0]["statistics"]
+    decimated = data.values[::2, ::2]
+    assert stats["maximum"] == decimated.max()
+    assert stats["mean"] == decimated.mean()
+
+    stats = rioxarray_get_raster_info(data, max_size=1024)[0]["statistics"]
+    assert stats["maximum"] == data.values.max()
+
+
+def test_stac_validator_reuses_fetched_schemas():
+    validator = _get_stac_validator()
+    assert validator is _get_stac_validator()
+
+    item = pystac.Item(
+        id="R2S_TEST_ITEM",
+        geometry={"type": "Point", "coordinates": [11.0, 46.0]},
+        bbox=[11.0, 46.0, 11.0, 46.0],
+        datetime=datetime.datetime(2024, 1, 1),
+        properties={},
+    )
+    item.validate(validator=validator)
+    n_schemas = len(validator.schema_cache)
+    item.validate(validator=validator)
+    assert len(validator.schema_cache) == n_schemas
+
+    item.bbox = [11.0]
+    with pytest.raises(pystac.STACValidationError):
+        item.validate(validator=validator)
+
+
 @patch("boto3.client")
 def test_upload_s3(mock_boto_client, r2s_sample_data_array):
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -318,9 +604,47 @@ def test_upload_s3(mock_boto_client, r2s_sample_data_array):
     r2s.upload_s3(str(out_path))
 
     mock_s3_client.upload_file.assert_called_with(
-        str(out_path), "sample_bucket", "sample_prefix/S3_COLLECTION"
+        str(out_path),
+        "sample_bucket",
+        "sample_prefix/S3_COLLECTION",
+        Config=r2s.s3_transfer_config,
+    )
+    assert r2s.s3_transfer_config.multipart_chunksize == 64 * 1024 * 1024
+    # every part of every concurrent upload gets its own HTTP connection
+    client_config = mock_boto_client.call_args.kwargs["config"]
+    assert client_config.max_pool_connections >= (
+        _S3_MAX_WORKERS * r2s.s3_transfer_config.max_concurrency
     )
 
 
+@patch("boto3.client")
+def test_generate_cog_stac_uploads_s3(mock_boto_client, r2s_sample_dataset):
+    mock_s3_client = MagicMock()
+    mock_boto_client.return_value = mock_s3_client
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        r2s = Raster2STAC(
+            data=r2s_sample_dataset,
+            collection_id="S3_COLLECTION",
+            collection_url="https://10.8.244.74:8082/collections/",
+            output_folder=os.path.join(tmpdir, "S3_COLLECTION"),
+            ignore_warns=True,
+            s3_upload=True,
+            bucket_name="sample_bucket",
+            bucket_file_prefix="sample_prefix",
+        )
+        r2s.generate_cog_stac()
+
+    # every COG and the collection JSON are uploaded
+    uploaded = sorted(
+        call.args[2] for call in mock_s3_client.upload_file.call_args_list
+    )
+    assert uploaded == [
+        "sample_prefix/S3_COLLECTION.json",
+        "sample_prefix/raster2stac_dataset_band1_20240606000000.tif",
+        "sample_prefix/raster2stac_dataset_band2_20240606000000.tif",
+    ]
+
+
 if __name__ == "__main__":
     pytest.main()